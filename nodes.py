@@ -1,24 +1,134 @@
 import torch
-import kornia
+import torch.nn.functional as F
 import math
-from kornia.geometry.transform import build_laplacian_pyramid
+import functools
+import os
+
+def _compile(fn):
+    """
+    Wraps fn with torch.compile when FDG_TORCH_COMPILE=1 is set, falling back to
+    eager execution if compilation fails.
+
+    Compilation is opt-in because FDG only runs for the first few steps, so the
+    one-off compile per shape is rarely paid back at default settings.
+    """
+    if os.environ.get("FDG_TORCH_COMPILE") != "1" or not hasattr(torch, "compile"):
+        return fn
+    from torch._dynamo.exc import TorchDynamoException
+    compiled = torch.compile(fn, dynamic=False)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        nonlocal compiled
+        if compiled is not fn:
+            try:
+                return compiled(*args, **kwargs)
+            except TorchDynamoException as e:
+                # Only tracing/backend failures (e.g. no Triton), runtime errors propagate
+                print(f"FDG: torch.compile failed ({e}). Falling back to eager mode.")
+                compiled = fn
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+def _dot(a: torch.Tensor, b: torch.Tensor):
+    """
+    Per-sample inner product over the last three dims.
+
+    Only the reduction needs extra precision, so it accumulates in at least
+    float32 while the elementwise product stays in the working dtype.
+    """
+    acc_dtype = torch.promote_types(a.dtype, torch.float32)
+    return (a * b).sum(dim=[-1, -2, -3], keepdim=True, dtype=acc_dtype)
+
+def _unit(v1: torch.Tensor):
+    """Normalizes v1 over the last three dims."""
+    # Scale in the accumulator dtype before casting, the inverse norm of a
+    # near-zero v1 overflows half precision
+    return (v1 * torch.rsqrt(_dot(v1, v1) + 1e-12)).to(v1.dtype)
+
+def _project(v0: torch.Tensor, v1_hat: torch.Tensor):
+    """Projects v0 onto an already normalized v1_hat, so the normalization can be reused."""
+    v0_parallel = _dot(v0, v1_hat).to(v0.dtype) * v1_hat
+    v0_orthogonal = v0 - v0_parallel
+    return v0_parallel, v0_orthogonal
 
 def project(v0: torch.Tensor, v1: torch.Tensor):
     """Projects tensor v0 onto v1 and returns parallel and orthogonal components."""
-    dtype = v0.dtype
-    v0, v1 = v0.double(), v1.double()
-    v1 = torch.nn.functional.normalize(v1, dim=[-1, -2, -3])
-    v0_parallel = (v0 * v1).sum(dim=[-1, -2, -3], keepdim=True) * v1
-    v0_orthogonal = v0 - v0_parallel
-    return v0_parallel.to(dtype), v0_orthogonal.to(dtype)
+    # _guide_level never builds a unit vector, it folds the norm into its coefficient
+    return _project(v0, _unit(v1))
+
+def _guide_level(p_cond: torch.Tensor, p_uncond: torch.Tensor, scale, par_weight):
+    """Applies guidance to a single pyramid level, writing the result into p_cond."""
+    # Calculate the difference between conditional and unconditional predictions
+    diff = p_cond - p_uncond
+
+    # Add (par_weight - 1) of the parallel component back, with the coefficient
+    # kept in the accumulator dtype where it cannot overflow half precision
+    coeff = _dot(diff, p_cond) / (_dot(p_cond, p_cond) + 1e-12)
+    diff.addcmul_((par_weight - 1) * coeff, p_cond)
+
+    # Apply guidance
+    return p_cond.addcmul_(diff, scale - 1)
+
+def _level_params(scales, weights, device: torch.device):
+    """Packs per-level scales and weights into one (2, levels) float32 tensor on device."""
+    return torch.tensor([scales, weights], dtype=torch.float32, device=device)
+
+def _upsample(x: torch.Tensor, size):
+    """Bilinearly upsamples x to the given spatial size."""
+    return F.interpolate(x, size=size, mode="bilinear", align_corners=False)
+
+def _laplacian_pyramid(x: torch.Tensor, levels: int):
+    """Builds a laplacian pyramid of x, finest level first."""
+    pyramid = []
+    for _ in range(levels - 1):
+        down = F.avg_pool2d(x, 2)
+        pyramid.append(x - _upsample(down, x.shape[-2:]))
+        x = down
+    pyramid.append(x)
+    return pyramid
 
 def build_image_from_pyramid(pyramid):
     """Reconstructs image from laplacian pyramid."""
     img = pyramid[-1]
-    for i in range(len(pyramid) - 2, -1, -1):
-        img = kornia.geometry.pyrup(img) + pyramid[i]
+    for level in reversed(pyramid[:-1]):
+        # Upsample to the stored level size so odd sizes need no cropping,
+        # then accumulate into the freshly upsampled tensor
+        img = _upsample(img, level.shape[-2:]).add_(level)
     return img
 
+@_compile
+def _guide_pyramid(pred_cond, pred_uncond, level_params, guided, projected):
+    """
+    Decomposes, guides and reconstructs the predictions.
+
+    The per-level branches are chosen by the static guided/projected flags, so when
+    compiled the level loop is unrolled into one graph and the fuser sees every level.
+    """
+    scales, weights = level_params.unbind(0)
+
+    # Decompose both predictions in one batch, the pyramid ops are per-sample.
+    # Pooling, upsampling and the elementwise ops all vectorize better in NHWC.
+    stacked = torch.cat([pred_cond, pred_uncond], dim=0).contiguous(memory_format=torch.channels_last)
+    stacked_pyramid = _laplacian_pyramid(stacked, len(guided))
+    pred_guided_pyramid = []
+
+    # The pyramid levels are owned here, so each guided level overwrites its cond half
+    for idx, level in enumerate(stacked_pyramid):
+        p_cond, p_uncond = level.chunk(2, dim=0)
+        if not guided[idx]:
+            # No guidance on this level, whatever the parallel weight
+            pred_guided_pyramid.append(p_cond)
+        elif not projected[idx]:
+            # Reweighting leaves the difference unchanged, skip the projection
+            pred_guided_pyramid.append(p_cond.addcmul_(p_cond - p_uncond, scales[idx] - 1))
+        else:
+            pred_guided_pyramid.append(_guide_level(p_cond, p_uncond, scales[idx], weights[idx]))
+
+    # Reconstruct the image from the guided pyramid
+    return build_image_from_pyramid(pred_guided_pyramid)
+
 def laplacian_guidance(
     pred_cond: torch.Tensor,
     pred_uncond: torch.Tensor,
@@ -37,47 +147,38 @@ def laplacian_guidance(
         pred_uncond: The unconditional prediction from the model.
         guidance_scale: A list of guidance scales for each pyramid level.
         parallel_weights: A list of weights for the parallel component of the
-                          difference vector at each pyramid level.
+                          difference vector, one per pyramid level.
     """
-    levels = len(guidance_scale)
     if parallel_weights is None:
-        parallel_weights = [1.0] * levels
+        parallel_weights = [1.0] * len(guidance_scale)
 
-    original_size = pred_cond.shape[-2:]
-    pred_cond_pyramid = build_laplacian_pyramid(pred_cond, levels)
-    pred_uncond_pyramid = build_laplacian_pyramid(pred_uncond, levels)
-    pred_guided_pyramid = []
-
-    parameters = zip(
-        pred_cond_pyramid,
-        pred_uncond_pyramid,
-        guidance_scale,
-        parallel_weights
+    return _laplacian_guidance(
+        pred_cond,
+        pred_uncond,
+        _level_params(guidance_scale, parallel_weights, pred_cond.device),
+        tuple(scale != 1.0 for scale in guidance_scale),
+        tuple(par_weight != 1.0 for par_weight in parallel_weights)
     )
 
-    for idx, (p_cond, p_uncond, scale, par_weight) in enumerate(parameters):
-        # Crop the padding area added by build_laplacian_pyramid
-        level_size = (original_size[0] // (2 ** idx), original_size[1] // (2 ** idx))
-        p_cond = p_cond[..., :level_size[0], :level_size[1]]
-        p_uncond = p_uncond[..., :level_size[0], :level_size[1]]
-
-        # Calculate the difference between conditional and unconditional predictions
-        diff = p_cond - p_uncond
-
-        # Project the difference vector onto the conditional prediction
-        diff_parallel, diff_orthogonal = project(diff, p_cond)
-
-        # Apply parallel weights to the parallel component
-        diff = par_weight * diff_parallel + diff_orthogonal
-
-        # Apply guidance
-        p_guided = p_cond + (scale - 1) * diff
-        pred_guided_pyramid.append(p_guided)
-
-    # Reconstruct the image from the guided pyramid
-    pred_guided = build_image_from_pyramid(pred_guided_pyramid)
+def _laplacian_guidance(pred_cond, pred_uncond, level_params, guided, projected):
+    """Runs the pyramid pass with precomputed level parameters and flags."""
+    # The pyramid pass takes the parameters as one packed tensor, so it is
+    # neither recompiled per value nor fed fresh host scalars every step. Only
+    # which levels need work is baked in.
+    pred_guided = _guide_pyramid(
+        pred_cond,
+        pred_uncond,
+        level_params,
+        guided,
+        projected
+    )
 
-    return pred_guided.to(pred_cond.dtype)
+    # Hand the result back in the caller's dtype and memory format
+    if pred_cond.is_contiguous(memory_format=torch.channels_last):
+        memory_format = torch.channels_last
+    else:
+        memory_format = torch.contiguous_format
+    return pred_guided.to(pred_cond.dtype, memory_format=memory_format)
 
 
 def create_guidance_scales(high_scale, low_scale, levels, method="linear"):
@@ -85,15 +186,16 @@ def create_guidance_scales(high_scale, low_scale, levels, method="linear"):
     if levels == 1:
         return [high_scale]
 
+    # Blend as (1 - w) * low + w * high so both endpoints are exact
+    t = [i / (levels - 1) for i in range(levels)]
     if method == "linear":
-        scales = torch.linspace(high_scale, low_scale, levels)
+        weights = [1 - x for x in t]
     elif method == "cosine":
-        t = torch.linspace(0, 1, levels)
-        scales = low_scale + (high_scale - low_scale) * 0.5 * (1 + torch.cos(t * math.pi))
+        weights = [0.5 * (1 + math.cos(x * math.pi)) for x in t]
     else:
         raise ValueError(f"Unknown interpolation method: {method}")
 
-    return scales.tolist()
+    return [(1 - w) * low_scale + w * high_scale for w in weights]
 
 class FDGNode:
     @classmethod
@@ -140,12 +242,14 @@ class FDGNode:
     def patch(self, model, guidance_scale_high, guidance_scale_low, levels, fdg_steps, interpolation_method="linear", parallel_weights="1.0,1.0,1.0,1.0"):
 
         # Create guidance scales for each pyramid level
-        guidance_scale = create_guidance_scales(guidance_scale_high, guidance_scale_low, levels, interpolation_method)
+        guidance_scale = tuple(create_guidance_scales(guidance_scale_high, guidance_scale_low, levels, interpolation_method))
         
         # Parse the parallel_weights string into a list of floats
         try:
             parallel_weights_list = [float(w.strip()) for w in parallel_weights.split(',')]
-        except:
+            if not all(math.isfinite(w) for w in parallel_weights_list):
+                raise ValueError("non-finite parallel weight")
+        except ValueError:
             print("FDG: Invalid parallel_weights format. Using default [1.0] * levels.")
             parallel_weights_list = [1.0] * levels
 
@@ -155,6 +259,19 @@ class FDGNode:
         elif len(parallel_weights_list) > levels:
             parallel_weights_list = parallel_weights_list[:levels]
 
+        # Which levels need work is fixed for the whole run. The packed parameters
+        # are moved to the latent device on the first guided step and reused.
+        guided = tuple(scale != 1.0 for scale in guidance_scale)
+        projected = tuple(par_weight != 1.0 for par_weight in parallel_weights_list)
+        level_params_cache = {}
+
+        # With every level at scale 1 FDG returns cond unchanged, whatever the
+        # parallel weights, so the early steps can skip the pyramid entirely
+        fdg_is_identity = not any(guided)
+
+        # FDG/CFG switch threshold, read back once per sampling run
+        threshold_cache = {"sample_sigmas": None, "threshold": None}
+
         def fdg_function(args):
             cond = args["cond"]
             uncond = args["uncond"]
@@ -164,14 +281,24 @@ class FDGNode:
             step_limits = fdg_steps
             """Use CFG after limited FDG application for early steps."""
             if uncond is not None:
-                if step_limits >= (len(sample_sigmas) - 1):
-                    step_limits = len(sample_sigmas) - 1
-                if sigma.item() > sample_sigmas[step_limits].item():
-                    return laplacian_guidance(
+                if threshold_cache["sample_sigmas"] is not sample_sigmas:
+                    if step_limits >= (len(sample_sigmas) - 1):
+                        step_limits = len(sample_sigmas) - 1
+                    threshold_cache["sample_sigmas"] = sample_sigmas
+                    threshold_cache["threshold"] = sample_sigmas[step_limits].item()
+                if sigma.item() > threshold_cache["threshold"]:
+                    if fdg_is_identity:
+                        return cond
+                    level_params = level_params_cache.get(cond.device)
+                    if level_params is None:
+                        level_params = _level_params(guidance_scale, parallel_weights_list, cond.device)
+                        level_params_cache[cond.device] = level_params
+                    return _laplacian_guidance(
                         cond,
                         uncond,
-                        guidance_scale,
-                        parallel_weights_list
+                        level_params,
+                        guided,
+                        projected
                     )
                 else: 
                     cond = uncond + (cond - uncond) * cond_scale
@@ -180,6 +307,8 @@ class FDGNode:
                 return cond
         
         m = model.clone()
-        m.set_model_sampler_cfg_function(fdg_function, disable_cfg1_optimization=True)
+        # The identity case also has guidance_scale_high == 1, so at cfg 1 every
+        # step returns cond and ComfyUI may skip computing uncond
+        m.set_model_sampler_cfg_function(fdg_function, disable_cfg1_optimization=not fdg_is_identity)
         return (m,)
 
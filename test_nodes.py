@@ -1,6 +1,43 @@
+import contextlib
+import io
 import unittest
 import torch
-from nodes import create_guidance_scales
+from nodes import FDGNode, create_guidance_scales, build_image_from_pyramid, laplacian_guidance, project, _laplacian_pyramid
+
+def reference_guidance(pred_cond, pred_uncond, guidance_scale, parallel_weights):
+    """Unfused per-level guidance, as originally written with project."""
+    levels = len(guidance_scale)
+    parameters = zip(
+        _laplacian_pyramid(pred_cond, levels),
+        _laplacian_pyramid(pred_uncond, levels),
+        guidance_scale,
+        parallel_weights
+    )
+    pred_guided_pyramid = []
+    for p_cond, p_uncond, scale, par_weight in parameters:
+        diff_parallel, diff_orthogonal = project(p_cond - p_uncond, p_cond)
+        diff = par_weight * diff_parallel + diff_orthogonal
+        pred_guided_pyramid.append(p_cond + (scale - 1) * diff)
+    return build_image_from_pyramid(pred_guided_pyramid)
+
+class StubModel:
+    """Records the cfg function FDGNode.patch registers on its clone."""
+
+    def clone(self):
+        return StubModel()
+
+    def set_model_sampler_cfg_function(self, cfg_function, disable_cfg1_optimization=False):
+        self.cfg_function = cfg_function
+        self.disable_cfg1_optimization = disable_cfg1_optimization
+
+def cfg_args(cond, uncond, sigma, sample_sigmas, cond_scale=1.0):
+    return {
+        "cond": cond,
+        "uncond": uncond,
+        "cond_scale": cond_scale,
+        "sigma": torch.tensor([sigma]),
+        "model_options": {"transformer_options": {"sample_sigmas": sample_sigmas}},
+    }
 
 class TestFDGNode(unittest.TestCase):
 
@@ -17,6 +54,12 @@ class TestFDGNode(unittest.TestCase):
         self.assertAlmostEqual(scales[0], 10.0)
         self.assertAlmostEqual(scales[-1], 1.0)
 
+    def test_create_guidance_scales_exact_endpoints(self):
+        for method in ("linear", "cosine"):
+            scales = create_guidance_scales(1.1, 5.2, 4, method)
+            self.assertEqual(scales[0], 1.1)
+            self.assertEqual(scales[-1], 5.2)
+
     def test_create_guidance_scales_single_level(self):
         scales = create_guidance_scales(10.0, 1.0, 1)
         self.assertEqual(scales, [10.0])
@@ -25,5 +68,109 @@ class TestFDGNode(unittest.TestCase):
         with self.assertRaises(ValueError):
             create_guidance_scales(10.0, 1.0, 4, "invalid")
 
+    def test_laplacian_pyramid_shapes(self):
+        pyramid = _laplacian_pyramid(torch.randn(1, 4, 13, 19), 3)
+        self.assertEqual([p.shape[-2:] for p in pyramid], [(13, 19), (6, 9), (3, 4)])
+
+    def test_build_image_from_pyramid_roundtrip(self):
+        x = torch.randn(2, 4, 13, 19)
+        pyramid = _laplacian_pyramid(x, 4)
+        self.assertTrue(torch.allclose(build_image_from_pyramid(pyramid), x, atol=1e-5))
+
+    def test_laplacian_guidance_unit_scales_is_identity(self):
+        cond, uncond = torch.randn(2, 1, 4, 16, 16).unbind(0)
+        guided = laplacian_guidance(cond, uncond, [1.0, 1.0, 1.0], [2.0, 0.5, 1.0])
+        self.assertTrue(torch.allclose(guided, cond, atol=1e-5))
+
+    def test_laplacian_guidance_matches_reference(self):
+        # Levels 0 and 2 take the projected branch, level 1 the unprojected one
+        cond, uncond = torch.randn(2, 2, 4, 13, 19).unbind(0)
+        scales, weights = [5.0, 3.0, 2.0], [0.5, 1.0, 1.5]
+        expected = reference_guidance(cond.double(), uncond.double(), scales, weights)
+        guided = laplacian_guidance(cond, uncond, scales, weights)
+        self.assertEqual(guided.dtype, cond.dtype)
+        self.assertTrue(torch.allclose(guided.double(), expected, atol=1e-4))
+
+    def test_half_precision_is_finite_and_close(self):
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        zeros = torch.zeros(2, 4, 13, 19, dtype=torch.float16, device=device)
+        noise = torch.randn(2, 4, 13, 19, dtype=torch.float16, device=device)
+        scales, weights = [5.0, 3.0], [0.5, 1.5]
+
+        for v1 in (zeros, noise * 1e-4):
+            for component in project(noise, v1):
+                self.assertTrue(torch.isfinite(component).all())
+            self.assertTrue(torch.isfinite(laplacian_guidance(v1, noise, scales, weights)).all())
+
+        cond, uncond = noise, torch.randn_like(noise)
+        expected = reference_guidance(cond.double(), uncond.double(), scales, weights)
+        guided = laplacian_guidance(cond, uncond, scales, weights)
+        self.assertEqual(guided.dtype, torch.float16)
+        self.assertTrue(torch.allclose(guided.double(), expected, rtol=1e-2, atol=5e-2))
+
+    def test_laplacian_guidance_keeps_memory_format(self):
+        cond, uncond = torch.randn(2, 2, 4, 13, 19).unbind(0)
+        scales, weights = [7.5, 3.0], [1.5, 1.0]
+        guided = laplacian_guidance(cond, uncond, scales, weights)
+        self.assertTrue(guided.is_contiguous())
+
+        guided_nhwc = laplacian_guidance(
+            cond.contiguous(memory_format=torch.channels_last),
+            uncond.contiguous(memory_format=torch.channels_last),
+            scales,
+            weights
+        )
+        self.assertTrue(guided_nhwc.is_contiguous(memory_format=torch.channels_last))
+        self.assertTrue(torch.allclose(guided_nhwc, guided, atol=1e-5))
+
+    def test_patch_identity_keeps_cfg1_optimization(self):
+        cond, uncond = torch.randn(2, 1, 4, 16, 16).unbind(0)
+        sigmas = torch.tensor([10.0, 8.0, 6.0, 4.0, 0.0])
+
+        (m,) = FDGNode().patch(StubModel(), 1.0, 1.0, 2, 2, "linear", "2.0,0.5")
+        self.assertFalse(m.disable_cfg1_optimization)
+        self.assertIs(m.cfg_function(cfg_args(cond, uncond, 10.0, sigmas, 3.0)), cond)
+
+        for high, low in ((7.5, 1.0), (1.0, 3.0)):
+            (m,) = FDGNode().patch(StubModel(), high, low, 2, 2)
+            self.assertTrue(m.disable_cfg1_optimization)
+
+    def test_patch_switches_to_cfg_at_fdg_steps(self):
+        cond, uncond = torch.randn(2, 1, 4, 16, 16).unbind(0)
+        cfg = uncond + (cond - uncond) * 3.0
+
+        def uses_fdg(m, sigma, sample_sigmas):
+            out = m.cfg_function(cfg_args(cond, uncond, sigma, sample_sigmas, 3.0))
+            if out is cond:
+                return True
+            self.assertTrue(torch.allclose(out, cfg))
+            return False
+
+        # Identity FDG returns cond itself, so the chosen branch is visible
+        sigmas = torch.tensor([10.0, 8.0, 6.0, 4.0, 0.0])
+        (m,) = FDGNode().patch(StubModel(), 1.0, 1.0, 2, 2)
+        self.assertEqual([uses_fdg(m, s, sigmas) for s in sigmas[:-1].tolist()], [True, True, False, False])
+
+        # A new sampling run refreshes the cached threshold
+        sigmas = torch.tensor([20.0, 16.0, 12.0, 8.0, 0.0])
+        self.assertEqual([uses_fdg(m, s, sigmas) for s in sigmas[:-1].tolist()], [True, True, False, False])
+
+        # fdg_steps past the end is clamped, so FDG covers every step
+        (m,) = FDGNode().patch(StubModel(), 1.0, 1.0, 2, 50)
+        self.assertEqual([uses_fdg(m, s, sigmas) for s in sigmas[:-1].tolist()], [True, True, True, True])
+
+    def test_patch_invalid_parallel_weights_fall_back_to_ones(self):
+        cond, uncond = torch.randn(2, 1, 4, 16, 16).unbind(0)
+        sigmas = torch.tensor([10.0, 8.0, 6.0, 4.0, 0.0])
+        expected = laplacian_guidance(cond, uncond, create_guidance_scales(7.5, 1.0, 2), [1.0, 1.0])
+
+        for weights in ("nan,1", "inf", "abc"):
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout):
+                (m,) = FDGNode().patch(StubModel(), 7.5, 1.0, 2, 2, "linear", weights)
+            self.assertIn("Invalid parallel_weights", stdout.getvalue())
+            guided = m.cfg_function(cfg_args(cond, uncond, 10.0, sigmas))
+            self.assertTrue(torch.allclose(guided, expected, atol=1e-6))
+
 if __name__ == '__main__':
     unittest.main()